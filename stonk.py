@@ -5,8 +5,15 @@ import os
 import random
 import re
 import sqlite3
+import string
+import sys
+import traceback
 from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_UP
+from itertools import combinations, islice, product
+from typing import Literal
 from discord.ext import commands, tasks
 
 ######### Definitions #########
@@ -19,6 +26,50 @@ ChannelCountResult = namedtuple('ChannelCountResult', ['msg_count', 'emoji_count
 # same as above, but channel_counts is a Counter
 ServerCountResult = namedtuple('ServerCountResult', ['channel_counts', 'emoji_counts'])
 
+# Raised inside a transaction to roll it back, the message is meant for the user
+class AbortTransaction(Exception):
+    pass
+
+# Matches custom emojis in message content, <a:name:id> if animated, else <:name:id>
+EMOJI_RE = re.compile(r'<a?:\w+:\d+>')
+_GAMERTAG_RE = re.compile(r'[a-z0-9]{1,11}')
+_NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9]')
+
+# (price cap, increase per message while below the cap), see get_increase_stock_value()
+PRICE_TIERS = ((100, 1.0), (200, 0.8), (300, 0.5), (400, 0.2), (500, 0.1), (math.inf, 0.05))
+
+# Balances are stored as integer cents, see to_cents()
+CENT = Decimal("0.01")
+STARTING_BALANCE_CENTS = 100000 * 100
+# Largest $givemoney amount, keeps the cents well inside SQLite's 64 bit INTEGER
+MAX_GIVE_AMOUNT = 1e12
+
+# Hot SQL statements, shared so every call site hits the same entry in sqlite3's statement cache
+SQL_GET_USER = "SELECT user_id FROM users WHERE user_id = ?"
+SQL_GET_BALANCE = "SELECT balance_cents FROM users WHERE user_id = ?"
+SQL_CREDIT_BALANCE = "UPDATE users SET balance_cents = balance_cents + ? WHERE user_id = ? RETURNING balance_cents"
+SQL_GET_STOCK_VALUE = "SELECT stock_value FROM stocks WHERE stock_name = ?"
+SQL_GET_HOLDING = "SELECT quantity FROM stock_holdings WHERE user_id = ? AND stock_name = ?"
+SQL_SET_STOCK_VALUE = "UPDATE stocks SET stock_value = ? WHERE stock_name = ?"
+SQL_GET_USER_BY_GAMERTAG = "SELECT user_id FROM users WHERE gamertag = ?"
+SQL_SET_GAMERTAG = "UPDATE users SET gamertag = ? WHERE user_id = ?"
+# Guarded updates, these change nothing if there isn't enough left
+SQL_DEBIT_BALANCE = ("UPDATE users SET balance_cents = balance_cents - ? WHERE user_id = ? AND balance_cents >= ? "
+                     "RETURNING balance_cents")
+SQL_TAKE_STOCK_AVAIL = ("UPDATE stocks SET stock_avail = stock_avail - ? WHERE stock_name = ? AND stock_avail >= ? "
+                        "RETURNING stock_avail")
+SQL_TAKE_HOLDING = ("UPDATE stock_holdings SET quantity = quantity - ? WHERE user_id = ? AND stock_name = ? AND quantity >= ? "
+                    "RETURNING quantity")
+# Debits the giver (first user_id) and credits the target in one statement, if the giver has enough. Returns both new balances
+SQL_TRANSFER_BALANCE = ("UPDATE users SET balance_cents = CASE user_id WHEN ? THEN balance_cents - ? ELSE balance_cents + ? END "
+                        "WHERE user_id IN (?, ?) AND (SELECT balance_cents FROM users WHERE user_id = ?) >= ? "
+                        "RETURNING user_id, balance_cents")
+# Adds to a holding, creating it if the user doesn't own the stock yet
+SQL_UPSERT_HOLDING = ("INSERT INTO stock_holdings (user_id, stock_name, quantity) VALUES (?, ?, ?) "
+                      "ON CONFLICT (user_id, stock_name) DO UPDATE SET quantity = quantity + excluded.quantity")
+# Same, but returns the new quantity
+SQL_UPSERT_HOLDING_RETURNING = SQL_UPSERT_HOLDING + " RETURNING quantity"
+
 ######### Bot class #########
 
 class StonkBot(commands.Bot):
@@ -27,23 +78,52 @@ class StonkBot(commands.Bot):
         intents.message_content = True  # Enable message content intent
         super().__init__(command_prefix="$", intents=intents)
 
-        self.conn = sqlite3.connect("stock_market.db")
+        self.conn = self.open_db_connection()
         self.c = self.conn.cursor()
         self.create_db()
 
+        # Database work that is moved off the event loop runs on this single thread, with its own connection
+        # (sqlite3 connections can't be shared between threads)
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stonk_db")
+        self.worker_conn = self.open_db_connection(check_same_thread=False)
+        # (func, args, future) of writes waiting for db_writer_task, see run_write(). Created in setup_hook(), on
+        # Python < 3.10 it has to be created while the bot's event loop is running
+        self.write_queue = None
+
         # vars
         self.emoji_set = None # Set in on_ready() -> initialize_stocks()
         self.ticker_to_name = dict()
         self.name_to_ticker = dict()
+        self.update_times = dict() # guild_id -> last update datetime, cache for get_update_time()
 
     ########### Initialization ###########
 
+    # Runs once, inside the event loop, before the bot connects
+    async def setup_hook(self):
+        self.write_queue = asyncio.Queue()
+
     async def on_ready(self):
         print(f"Logged in as {self.user}")
+        self.db_writer_task.start()
         await self.add_cog(StonkCog(self, self.conn))
         await self.initialize_stocks() 
         self.update_stocks_task.start()
 
+    # Opens a connection to the bot database with our tuning applied
+    def open_db_connection(self, **kwargs):
+        conn = sqlite3.connect("stock_market.db", cached_statements=512, **kwargs)
+        # Rows can be unpacked like tuples or read by column name
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers run alongside the hourly update, NORMAL sync is still crash-safe under WAL
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-64000") # 64MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456") # 256MB
+        # The command and db thread connections both write, wait for the other one's lock instead of failing
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
     # Create tables for users and stocks
     def create_db(self):
         # Users table, stores basic user info
@@ -68,9 +148,70 @@ class StonkBot(commands.Bot):
             CREATE TABLE IF NOT EXISTS metadata (
                 guild_id INTEGER PRIMARY KEY,
                 update_time_iso TEXT)''')
+        # Stores the ticker each channel/emoji was given, so tickers don't need to be regenerated on startup
+        self.c.execute('''CREATE TABLE IF NOT EXISTS ticker_map (
+                    ticker TEXT PRIMARY KEY,
+                    source_name TEXT UNIQUE)''')
+        self.migrate_db()
+
+        # Covers the per-kind "ORDER BY stock_value DESC" listings
+        self.c.execute('''CREATE INDEX IF NOT EXISTS idx_stocks_kind_val
+                    ON stocks (kind, stock_value DESC, stock_name, stock_avail)''')
+        # Gamertag lookups (transfers, rename), also makes sure each gamertag is only used once.
+        # (user_id, stock_name) lookups on stock_holdings are already covered by its primary key
+        self.c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_gamertag ON users (gamertag)")
         
         self.conn.commit()
 
+    # Brings the tables created above up to the current schema. PRAGMA user_version holds the last step applied.
+    # Each step runs in its own transaction, otherwise sqlite3 would autocommit the DDL on its own and a step that
+    # fails halfway would leave the schema changed without the version bump
+    def migrate_db(self):
+        self.c.execute("PRAGMA user_version")
+        version = self.c.fetchone()[0]
+
+        if version < 1:
+            # Stock kind, "C" for channel or "E" for emoji, so listings don't have to filter on the ticker prefix
+            with self.conn:
+                self.c.execute("BEGIN")
+                self.c.execute("ALTER TABLE stocks ADD COLUMN kind TEXT NOT NULL DEFAULT ''")
+                self.c.execute("UPDATE stocks SET kind = substr(stock_name, 1, 1)")
+                self.c.execute("DROP INDEX IF EXISTS idx_stocks_prefix_val")
+                self.c.execute("PRAGMA user_version = 1")
+
+        if version < 2:
+            # Gamertags are unique from now on, but register never checked that. Keep the oldest user of a duplicated
+            # gamertag, the others lose it and can pick a new one with $rename
+            with self.conn:
+                self.c.execute("BEGIN")
+                self.c.execute("UPDATE users SET gamertag = NULL WHERE rowid NOT IN (SELECT MIN(rowid) FROM users GROUP BY gamertag)")
+                self.c.execute("PRAGMA user_version = 2")
+
+        if version < 3:
+            # Balances move from REAL dollars to INTEGER cents, so transfers and purchases can't leave fractions of a cent
+            with self.conn:
+                self.c.execute("BEGIN")
+                self.c.execute("ALTER TABLE users ADD COLUMN balance_cents INTEGER")
+                self.c.execute("UPDATE users SET balance_cents = CAST(round(balance * 100) AS INTEGER)")
+                self.c.execute("ALTER TABLE users DROP COLUMN balance")
+                self.c.execute("PRAGMA user_version = 3")
+
+        if version < 4:
+            # Every user has a balance that can't go negative, enforced by the schema. SQLite can't add constraints
+            # to an existing column, so the table is rebuilt. idx_users_gamertag goes with the old table, create_db()
+            # recreates it
+            with self.conn:
+                self.c.execute("BEGIN")
+                self.c.execute('''CREATE TABLE users_new (
+                                user_id INTEGER PRIMARY KEY,
+                                gamertag TEXT,
+                                balance_cents INTEGER NOT NULL DEFAULT 0 CHECK (balance_cents >= 0))''')
+                self.c.execute('''INSERT INTO users_new (user_id, gamertag, balance_cents)
+                                SELECT user_id, gamertag, MAX(COALESCE(balance_cents, 0), 0) FROM users''')
+                self.c.execute("DROP TABLE users")
+                self.c.execute("ALTER TABLE users_new RENAME TO users")
+                self.c.execute("PRAGMA user_version = 4")
+
     # Initialize stocks based on message activity in the last 5 days
     async def initialize_stocks(self):
         await self.wait_until_ready()
@@ -80,23 +221,27 @@ class StonkBot(commands.Bot):
         self.c.execute("SELECT stock_name FROM stocks")
         stocks = {stock_name for (stock_name,) in self.c.fetchall()}
 
+        # Load the tickers handed out on previous startups
+        self.c.execute("SELECT ticker, source_name FROM ticker_map")
+        for ticker_name, source_name in self.c.fetchall():
+            self.ticker_to_name[ticker_name] = source_name
+            self.name_to_ticker[source_name] = ticker_name
+
         server_count_result = await self.count_all_occurences_in_server(hours=120) # 5 days
 
+        # (stock_name, stock_value, stock_avail, kind) rows, inserted in one go at the end
+        new_stocks = []
+
         # Initialize channel stocks
         for channel in self.guilds[0].text_channels:
-            ticker_name = self.create_ticker_name("C", channel.name)
-
-            # These maps are stored in memory, so we need to regenerate on startup
-            self.ticker_to_name[ticker_name] = channel.name
-            self.name_to_ticker[channel.name] = ticker_name
+            ticker_name = self.get_ticker_name("C", channel.name, channel.name)
             if ticker_name in stocks:
                 continue
             try:
                 activity_count = server_count_result.channel_counts[channel.name]
                 price = self.get_initial_stock_value(activity_count)
 
-                self.c.execute("INSERT OR IGNORE INTO stocks (stock_name, stock_value, stock_avail) VALUES (?, ?, ?)", 
-                        (ticker_name, price, 10000))
+                new_stocks.append((ticker_name, price, 10000, "C"))
                 print(f"Created stock {ticker_name} referencing {channel.name} with value {price}")
             except discord.Forbidden:
                 # Skip channels that the bot can't access
@@ -106,34 +251,28 @@ class StonkBot(commands.Bot):
 
         
         # Initialize emoji stocks. We need to use a sorted list so the naming is the same across bot startups
-        sorted_emoji_list = sorted(list(self.emoji_set))
-        for emoji in sorted_emoji_list:
+        for emoji in sorted(self.emoji_set):
             count = server_count_result.emoji_counts[emoji]
-            ticker_name = self.create_ticker_name("E", self.get_emoji_name(emoji))
-
-            # These maps are stored in memory, so we need to regenerate on startup
-            self.ticker_to_name[ticker_name] = emoji
-            self.name_to_ticker[emoji] = ticker_name
+            ticker_name = self.get_ticker_name("E", emoji, self.get_emoji_name(emoji))
             if ticker_name in stocks:
                 continue
             price = self.get_initial_stock_value(count)
-
-            # Insert or update the stock in the database
-            self.c.execute("INSERT OR IGNORE INTO stocks (stock_name, stock_value, stock_avail) VALUES (?, ?, ?)", 
-                    (ticker_name, price, 10000))
+            new_stocks.append((ticker_name, price, 10000, "E"))
             print(f"Created stock {ticker_name} referencing {emoji} with value {price}")
 
+        self.c.executemany("INSERT OR IGNORE INTO stocks (stock_name, stock_value, stock_avail, kind) VALUES (?, ?, ?, ?)", new_stocks)
         self.conn.commit()
         print("Stock initialization complete")
 
     ############## Helper functions #################
 
     def get_emoji_set(self):
-        # Set comp: emojis have form <a:name:id> if animated, else <:name:id>
-        return {
-            f"<{'a' if emoji.animated else ''}:{emoji.name}:{emoji.id}>"
+        # emojis have form <a:name:id> if animated, else <:name:id>
+        # Frozen and interned, this is checked against every emoji in every scanned message
+        return frozenset(
+            sys.intern(f"<{'a' if emoji.animated else ''}:{emoji.name}:{emoji.id}>")
             for emoji in self.guilds[0].emojis
-        }
+        )
 
     def get_channel_stock_name(self, name_string):
         return f"channel_{name_string[:22]}"
@@ -142,109 +281,81 @@ class StonkBot(commands.Bot):
     def get_emoji_name(self, full_emoji_str):
         return f"{full_emoji_str.split(':')[1]}"
 
-    # Reduce each stock's value by 1%, with jitter
-    def decay_all_stock_prices(self):
-        self.c.execute("SELECT stock_name FROM stocks")
-        stocks = self.c.fetchall()
-        for (stock_name,) in stocks:
-            self.decay_stock_price(stock_name)
-        self.conn.commit()
-
-    # Does not commit
-    def decay_stock_price(self, stock_name):
-        self.c.execute("SELECT stock_name, stock_value FROM stocks WHERE stock_name = ?", (stock_name,))
-        result = self.c.fetchone()
+    # Decay each stock's value and move its availability towards the target, for all stocks in a single pass
+    # DOES NOT COMMIT!
+    def decay_and_avail_adjust_all_stocks(self, c):
+        c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks")
+        result = c.fetchall()
         if not result:
-            print(f"Tried to fetch stock {stock_name} (decay), but doesn't exist")
-            return
-        new_value = self.get_stock_decay_value(result[1])
-        self.c.execute("UPDATE stocks SET stock_value = ? WHERE stock_name = ?", (new_value, stock_name))
+            print("Failed to fetch any stocks (decay_and_avail_adjust)")
 
+        updates = [(self.get_stock_decay_value(stock_value), self.get_avail_adjust_value(stock_avail), stock_name)
+                   for stock_name, stock_value, stock_avail in result]
+        c.executemany("UPDATE stocks SET stock_value = ?, stock_avail = ? WHERE stock_name = ?", updates)
+
+    # Reduce a stock's value by 1.5-2.5%
     def get_stock_decay_value(self, old_value):
         return old_value * (1 + random.uniform(-0.025, -0.015))
 
-    async def increase_all_stock_prices(self):
-        server_count_result = await self.count_all_occurences_in_server(1)
-        for channel_name in server_count_result.channel_counts:
-            stock_name = self.name_to_ticker[channel_name]
-            activity_count = server_count_result.channel_counts[channel_name]
-            self.increase_stock_price(stock_name, activity_count)
-        for emoji_str in server_count_result.emoji_counts:
-            stock_name = self.name_to_ticker[emoji_str]
-            activity_count = server_count_result.emoji_counts[emoji_str]
-            self.increase_stock_price(stock_name, activity_count)
-        self.conn.commit()
-
     # Increase stock prices based on number of messages, with adjusted growth rate
     # DOES NOT COMMIT!
-    def increase_stock_price(self, stock_name, total_messages):
-        self.c.execute("SELECT stock_value FROM stocks WHERE stock_name = ?", (stock_name,))
-        result = self.c.fetchone()
-        if not result:
-            print(f"Tried to fetch stock {stock_name} (increase), but doesn't exist")
-            return
-        new_price = self.get_increase_stock_value(result[0], total_messages)
-        
-        self.c.execute("UPDATE stocks SET stock_value = ? WHERE stock_name = ?", (new_price, stock_name))
+    def increase_all_stock_prices(self, c, server_count_result):
+        # Map ticker -> activity count, then join against the current prices in memory
+        activity = {}
+        for channel_name, activity_count in server_count_result.channel_counts.items():
+            activity[self.name_to_ticker[channel_name]] = activity_count
+        for emoji_str, activity_count in server_count_result.emoji_counts.items():
+            activity[self.name_to_ticker[emoji_str]] = activity_count
+
+        c.execute("SELECT stock_name, stock_value FROM stocks")
+        prices = dict(c.fetchall())
+        updates = []
+        for stock_name, activity_count in activity.items():
+            if stock_name not in prices:
+                print(f"Tried to fetch stock {stock_name} (increase), but doesn't exist")
+                continue
+            updates.append((self.get_increase_stock_value(prices[stock_name], activity_count), stock_name))
 
-    def avail_based_price_adjustment_all_stocks(self):
-        self.c.execute("SELECT stock_name, stock_avail FROM stocks")
-        result = self.c.fetchall()
-        if not result:
-            print("Failed to fetch any stocks (avail_based_adjust)")
-        
-        for stock_name, stock_avail in result:
-            # Adjust the availability. Uses a normal distribution centered at 0.15 with a std of 0.075
-            # The distribution is used to pick a percentage of the "gap" between the current avail and the target
-            # avail to fill at any given time.
-            # Add a random small amount at the end to prevent getting stuck at target, then rounds to an int.
-            gap = 25000 - stock_avail
-            r = max(0, random.gauss(0.05, 0.025))
-            new_avail = round(stock_avail + (gap * r) + random.uniform(0, 25))
-            
-            # Update the stock price in the database
-            self.c.execute("UPDATE stocks SET stock_avail = ? WHERE stock_name = ?", (new_avail, stock_name))
-        
-        # Commit the changes to the database
-        self.conn.commit()
-        
+        c.executemany(SQL_SET_STOCK_VALUE, updates)
+
+    def get_avail_adjust_value(self, stock_avail):
+        # Adjust the availability. Uses a normal distribution centered at 0.15 with a std of 0.075
+        # The distribution is used to pick a percentage of the "gap" between the current avail and the target
+        # avail to fill at any given time.
+        # Add a random small amount at the end to prevent getting stuck at target, then rounds to an int.
+        gap = 25000 - stock_avail
+        r = max(0, random.gauss(0.05, 0.025))
+        return round(stock_avail + (gap * r) + random.uniform(0, 25))
 
+    # Each message adds a fixed step to the price, the step shrinks as the price passes each cap.
+    # Instead of looping per message, work out how many messages are spent in each tier.
     def get_increase_stock_value(self, current_price, total_messages):
-        for _ in range(total_messages):
-            if current_price < 100:
-                current_price += 1.0
-            elif current_price < 200:
-                current_price += 0.8
-            elif current_price < 300:
-                current_price += 0.5
-            elif current_price < 400:
-                current_price += 0.2
-            elif current_price < 500:
-                current_price += 0.1
-            else:
-                current_price += 0.05
+        remaining = total_messages
+        for cap, step in PRICE_TIERS:
+            if remaining <= 0:
+                break
+            if current_price >= cap:
+                continue
+            # messages until the price reaches the cap, the last one is allowed to overshoot it
+            room = (cap - current_price) / step
+            take = remaining if room >= remaining else math.ceil(room)
+            current_price += take * step
+            remaining -= take
         return current_price
 
+    # Balance plus the current value of all holdings in cents, or None if the user isn't registered
     def calculate_net_worth(self, user_id):
-        self.c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        self.c.execute('''SELECT u.balance_cents + CAST(round(COALESCE(SUM(s.stock_value * h.quantity), 0) * 100) AS INTEGER)
+                        FROM users u
+                        LEFT JOIN stock_holdings h ON h.user_id = u.user_id
+                        LEFT JOIN stocks s ON s.stock_name = h.stock_name
+                        WHERE u.user_id = ?
+                        GROUP BY u.user_id''', (user_id,))
         result = self.c.fetchone()
         if not result:
             print(f"calculate_net_worth: failed to fetch balance for user {user_id}")
-        net_worth = result[0]
-
-        # Fetch the user's stock holdings
-        self.c.execute('SELECT stock_name, quantity FROM stock_holdings WHERE user_id = ?', (user_id,))
-        holdings = self.c.fetchall()
-
-        # Calculate the value of the user's stocks
-        for stock_name, quantity in holdings:
-            self.c.execute('SELECT stock_value FROM stocks WHERE stock_name = ?', (stock_name,))
-            stock = self.c.fetchone()
-            if stock:
-                stock_price = stock[0]
-                net_worth += stock_price * quantity
-        
-        return net_worth
+            return None
+        return result[0]
 
     # Lazy generator based message counter
     # TODO: deprecated?
@@ -266,16 +377,22 @@ class StonkBot(commands.Bot):
         emoji_counter = Counter()
         after_time = datetime.now() - timedelta(hours=hours)
 
-        for channel in bot.guilds[0].text_channels:
-            try:
-                channel_count_result = await self.count_all_occurrences_in_channel(channel.history(limit=None, after=after_time))
-                channels_counter[channel.name] += channel_count_result.msg_count
-                emoji_counter += channel_count_result.emoji_counts
-            except discord.Forbidden:
+        # Scan all channels concurrently, discord.py takes care of the rate limiting
+        channels = self.guilds[0].text_channels
+        results = await asyncio.gather(
+            *(self.count_all_occurrences_in_channel(channel.history(limit=None, after=after_time)) for channel in channels),
+            return_exceptions=True)
+
+        for channel, channel_count_result in zip(channels, results):
+            if isinstance(channel_count_result, discord.Forbidden):
                 # Skip channels that the bot can't access
                 print(f"Skipping channel {channel.name} due to insufficient permissions.")
-            except Exception as e:
-                print(f"An error occurred with channel {channel.name}: {e}")
+            elif isinstance(channel_count_result, Exception):
+                print(f"An error occurred with channel {channel.name}: {channel_count_result}")
+            else:
+                # Each channel is only counted once. Counter.update adds in place, unlike +=
+                channels_counter[channel.name] = channel_count_result.msg_count
+                emoji_counter.update(channel_count_result.emoji_counts)
 
         return ServerCountResult(channels_counter, emoji_counter)
 
@@ -286,14 +403,29 @@ class StonkBot(commands.Bot):
     # Param: a channel.history object (async iterator of discord.Message).
     # Returns: a ChannelCountResult namedtuple
     async def count_all_occurrences_in_channel(self, ch) -> ChannelCountResult:
+        loop = asyncio.get_running_loop()
         msg_count = 0
-        emoji_count = Counter()
+        page = []
+        scans = []
         async for message in ch:
             msg_count += 1
-            for word in message.content.split():
-                if word in self.emoji_set:
-                    emoji_count[word] += 1
+            page.append(message.content)
+            # history() fetches 100 messages per request, scan each page on a worker thread while the next one loads
+            if len(page) == 100:
+                scans.append(loop.run_in_executor(None, self._scan_page, page))
+                page = []
+        if page:
+            scans.append(loop.run_in_executor(None, self._scan_page, page))
+
+        emoji_count = Counter()
+        for page_count in await asyncio.gather(*scans):
+            emoji_count.update(page_count)
         return ChannelCountResult(msg_count, emoji_count)
+
+    # Count the known emojis in a list of message contents
+    def _scan_page(self, contents) -> Counter:
+        emoji_set = self.emoji_set
+        return Counter(e for content in contents for e in EMOJI_RE.findall(content) if e in emoji_set)
             
     # Return an initial price for a given activity count
     def get_initial_stock_value(self, activity_count):
@@ -310,30 +442,49 @@ class StonkBot(commands.Bot):
                 price = self.get_increase_stock_value(price, average_per_hour)
         return price
 
-    def store_update_time(self, update_time):
+    # DOES NOT COMMIT!
+    def store_update_time(self, c, update_time):
         # Store the current update time in the metadata table
         update_time_str = update_time.isoformat()  # Convert datetime to ISO 8601 string
-        self.c.execute("INSERT OR REPLACE INTO metadata (guild_id, update_time_iso) VALUES (?, ?)", (self.guilds[0].id, update_time_str,))
-
-        self.conn.commit()
+        c.execute("INSERT OR REPLACE INTO metadata (guild_id, update_time_iso) VALUES (?, ?)", (self.guilds[0].id, update_time_str,))
 
     def get_update_time(self, guild_id):
+        # Only changes once per hour, so only hit the db the first time
+        if guild_id in self.update_times:
+            return self.update_times[guild_id]
+
         # Retrieve the last update time for a specific guild
         self.c.execute("SELECT update_time_iso FROM metadata WHERE guild_id = ?", (guild_id,))
         result = self.c.fetchone()
         if result:
-            return datetime.fromisoformat(result[0])  # Convert back to datetime object
+            update_time = datetime.fromisoformat(result[0])  # Convert back to datetime object
+            self.update_times[guild_id] = update_time
+            return update_time
         else:
             return None
         
     def check_gamertag(self, gamertag):
-        if not gamertag:
-            return False
-        return re.fullmatch(r'[a-z0-9]+', gamertag) and len(gamertag) <= 11
+        return gamertag is not None and _GAMERTAG_RE.fullmatch(gamertag) is not None
+
+    # Converts a dollar amount to integer cents, rounded to the nearest cent unless another decimal rounding mode is
+    # given. Goes through str() so floats like 0.29 (0.28999...) don't get truncated
+    def to_cents(self, amount, rounding=ROUND_HALF_UP):
+        return int(Decimal(str(amount)).quantize(CENT, rounding) * 100)
 
     # removes everything other than a-zA-Z0-9
     def clean_string(self, s):
-        return re.sub(r'[^a-zA-Z0-9]', '', s)
+        return _NON_ALNUM_RE.sub('', s)
+
+    # Returns the stored ticker for source_name (channel name or emoji str), creating one from fullname if it has none yet.
+    # DOES NOT COMMIT!
+    def get_ticker_name(self, prefix: str, source_name: str, fullname: str):
+        ticker_name = self.name_to_ticker.get(source_name)
+        if ticker_name is None:
+            ticker_name = self.create_ticker_name(prefix, fullname)
+            self.c.execute("INSERT INTO ticker_map (ticker, source_name) VALUES (?, ?)", (ticker_name, source_name))
+            self.ticker_to_name[ticker_name] = source_name
+            self.name_to_ticker[source_name] = ticker_name
+        return ticker_name
 
     # Attempts to create a unique ticker name for a given name of a stock
     def create_ticker_name(self, prefix: str, fullname: str):
@@ -348,29 +499,22 @@ class StonkBot(commands.Bot):
                 return r
 
         # If no valid result or length is too short, we append some chars and try to let the conflict resolution logic
-        # handle it until some kind of new result is found
-        for i in range(26):
-            for j in range(26):
-                for k in range(26):
-                    for l in range(26):
-                        for m in range(26):
-                            suffix = chr(65+i) + chr(65+j) + chr(65+k) + chr(65+l) + chr(65+m)
-                            r = self._iterate_possible_ticker_names(prefix, s + suffix);
-                            if r:
-                                return r
-
-        # give up, our map has like 5^26 entries or something
+        # handle it until some kind of new result is found. Suffixes go AAAAA, AAAAB, ... so names get the same tickers
+        # they always did, but only the first 1000 are tried instead of all 26^5.
+        for suffix in islice(product(string.ascii_uppercase, repeat=5), 1000):
+            r = self._iterate_possible_ticker_names(prefix, s + ''.join(suffix))
+            if r:
+                return r
+
+        # give up, something is very wrong with our map
         return None
     
+    # Tries every ordered pick of 5 chars from s, in the same order as five nested loops would
     def _iterate_possible_ticker_names(self, prefix, s):
-        for i in range(len(s)):
-            for j in range(i+1, len(s)):
-                for k in range(j+1, len(s)):
-                    for l in range(k+1, len(s)):
-                        for m in range(l+1, len(s)):
-                            r = prefix + s[i] + s[j] + s[k] + s[l] + s[m]
-                            if r not in self.ticker_to_name:
-                                return r
+        for chars in combinations(s, 5):
+            r = prefix + ''.join(chars)
+            if r not in self.ticker_to_name:
+                return r
         return None
             
 
@@ -378,26 +522,145 @@ class StonkBot(commands.Bot):
 
     ############## Task #############
 
-    # Background task to update stock prices every 10 seconds
+    # Background task to update stock prices every hour
     @tasks.loop(hours=1)
     async def update_stocks_task(self):
-        await self.increase_all_stock_prices()
-        self.avail_based_price_adjustment_all_stocks()
-        self.decay_all_stock_prices()
-        self.store_update_time(datetime.now())
+        server_count_result = await self.count_all_occurences_in_server(1)
+        # Hand the database work to the db thread so commands keep being served meanwhile
+        await self.run_db(self.apply_stock_updates, server_count_result)
         print("Stock prices updated")
 
+    # Runs func(*args) on the db thread
+    async def run_db(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
+
+    # Applies the whole hourly update as a single transaction. Runs on the db thread!
+    def apply_stock_updates(self, server_count_result):
+        update_time = datetime.now()
+        with self.worker_conn:
+            c = self.worker_conn.cursor()
+            # Take the write lock up front, so no trade can land between reading and rewriting the stock rows
+            c.execute("BEGIN IMMEDIATE")
+            self.increase_all_stock_prices(c, server_count_result)
+            self.decay_and_avail_adjust_all_stocks(c)
+            self.store_update_time(c, update_time)
+        # Only cache the new time once it's committed
+        self.update_times[self.guilds[0].id] = update_time
+
     @update_stocks_task.before_loop
     async def waitr(self):
         await self.wait_until_ready()
 
+    # Queues func(c, *args) for the next write batch and returns its result (or raises its exception)
+    async def run_write(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self.write_queue.put((func, args, future))
+        return await future
+
+    # Commits queued writes in batches of up to 32 per transaction, so a burst of commands shares one commit
+    @tasks.loop(seconds=0)
+    async def db_writer_task(self):
+        batch = [await self.write_queue.get()]
+        while len(batch) < 32 and not self.write_queue.empty():
+            batch.append(self.write_queue.get_nowait())
+
+        try:
+            results = await self.run_db(self.run_write_batch, batch)
+        except Exception as e:
+            # The transaction itself failed (e.g. the commit), nothing in the batch was written
+            results = [(None, e)] * len(batch)
+
+        for (_, _, future), (result, error) in zip(batch, results):
+            if future.done(): # the command was cancelled in the meantime
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # Runs a batch of writes in a single transaction. Each one gets its own savepoint, so one that raises only rolls back
+    # its own changes. Returns a (result, exception) per write. Runs on the db thread!
+    def run_write_batch(self, batch):
+        results = []
+        with self.worker_conn:
+            c = self.worker_conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            for func, args, _ in batch:
+                c.execute("SAVEPOINT write")
+                try:
+                    results.append((func(c, *args), None))
+                except Exception as e:
+                    c.execute("ROLLBACK TO write")
+                    results.append((None, e))
+                c.execute("RELEASE write")
+        return results
+
+    ############## Writes, run in batches on the db thread #############
+
+    # These are called through run_write(), so they don't block the event loop while they wait for locks or commit.
+    # They get the batch's cursor and must not commit. They raise AbortTransaction (which rolls back their changes)
+    # with a message for the user if nothing could be done.
+
+    # Moves amount cents from giver to target, returns the giver's new balance in cents
+    def transfer_money(self, c, giver_id, target_id, amount):
+        # Debit the giver and credit the target in a single statement, it only changes anything if the giver has
+        # enough money. Returns the new balances.
+        c.execute(SQL_TRANSFER_BALANCE, (giver_id, amount, amount, giver_id, target_id, giver_id, amount))
+        new_balances = dict(c.fetchall())
+
+        if not new_balances:
+            # Nothing was changed, look up why
+            c.execute(SQL_GET_BALANCE, (giver_id,))
+            giver_balance = c.fetchone()
+            if not giver_balance:
+                raise AbortTransaction("You need to register first! Use the `$register` command to get started.")
+            raise AbortTransaction(f"You only have ${giver_balance['balance_cents'] / 100:.2f}.")
+        elif target_id not in new_balances:
+            # Only the giver was debited, the target's id (from the gamertag cache) has no users row
+            raise AbortTransaction("That user is not registered, use $leaderboard to find gamertag")
+
+        return new_balances[giver_id]
+
+    # Moves amount of stock_name from giver to target, returns the giver's and the target's new quantity
+    def transfer_stocks(self, c, giver_id, target_id, stock_name, amount):
+        # Only takes the stocks if the giver has enough of them
+        c.execute(SQL_TAKE_HOLDING, (amount, giver_id, stock_name, amount))
+        result = c.fetchone()
+
+        if not result:
+            # Nothing was changed, look up why
+            c.execute(SQL_GET_HOLDING, (giver_id, stock_name))
+            giver_stock = c.fetchone()
+            if not giver_stock:
+                raise AbortTransaction(f"You don't own {stock_name}.")
+            raise AbortTransaction(f"You only have {giver_stock['quantity']} {stock_name}.")
+
+        # Foreign keys aren't enforced, make sure the holding is created for a registered user
+        c.execute(SQL_GET_USER, (target_id,))
+        if not c.fetchone():
+            raise AbortTransaction("That user is not registered, use $leaderboard to find gamertag")
+
+        # Adds the stocks to the target's holding, creating it if needed
+        c.execute(SQL_UPSERT_HOLDING_RETURNING, (target_id, stock_name, amount))
+        return result["quantity"], c.fetchone()["quantity"]
+
+    def change_gamertag(self, c, user_id, gamertag):
+        # The unique index on gamertag rejects the update if someone already has it
+        try:
+            c.execute(SQL_SET_GAMERTAG, (gamertag, user_id))
+        except sqlite3.IntegrityError:
+            raise AbortTransaction(f"The gamertag `{gamertag}` is already taken. Please choose a different one.")
+        if c.rowcount == 0:
+            raise AbortTransaction("You need to register first! Use the `$register` command to get started.")
+
 ############# Commands ##############
 class StonkCog(commands.Cog):
     def __init__(self, bot, conn):
         self.bot = bot
         self.conn = conn
         self.c = conn.cursor()
-        self.buy_lock = asyncio.Lock()
+        # gamertag -> user_id for transfer targets. Only $rename changes a user's gamertag, it updates this
+        self._gamertag_to_id: dict[str, int] = {}
 
     # Display current stock prices in an embed
     @commands.command(name="stocks")
@@ -410,11 +673,10 @@ class StonkCog(commands.Cog):
         mins = td / timedelta(minutes=1)
         embed.set_footer(text=f"Last update was {mins:.2f} minutes ago, next update in {(60-mins):.2f} minutes.")
 
-        self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_value > 0 AND stock_name LIKE 'C%' ORDER BY stock_value DESC")
+        self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_value > 0 AND kind = 'C' ORDER BY stock_value DESC")
         channel_stocks = self.c.fetchall()
-        channel_stock_list = ""
-        for stock_name, stock_value, stock_avail in channel_stocks:
-            channel_stock_list += f"`{stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
+        channel_stock_list = "".join(
+            f"`{stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n" for stock_name, stock_value, stock_avail in channel_stocks)
 
         embed.add_field(
             name="Channel (`details c[hannel]`)", 
@@ -422,11 +684,10 @@ class StonkCog(commands.Cog):
             inline=True
         )
 
-        self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_value > 0 AND stock_name LIKE 'E%' ORDER BY stock_value DESC LIMIT 20")
+        self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_value > 0 AND kind = 'E' ORDER BY stock_value DESC LIMIT 20")
         emoji_stocks = self.c.fetchall()
-        emoji_stock_list = ""
-        for stock_name, stock_value, stock_avail in emoji_stocks:
-            emoji_stock_list += f"`{stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
+        emoji_stock_list = "".join(
+            f"`{stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n" for stock_name, stock_value, stock_avail in emoji_stocks)
 
         embed.add_field(
             name="Emoji (`details e[moji]`)", 
@@ -446,21 +707,13 @@ class StonkCog(commands.Cog):
 
         embed = discord.Embed(color=discord.Color.og_blurple())
 
-        stock_list = ""
-        stock_list_list=[]
-
         if option == "c" or option == "channels":
             embed.title = "Channels detailed view, top 25"
-            self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_name LIKE 'C%' ORDER BY stock_value DESC LIMIT 25")
+            self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE kind = 'C' ORDER BY stock_value DESC LIMIT 25")
             stocks = self.c.fetchall()
-            for stock_name, stock_value, stock_avail in stocks:
-                stock_list += f"`{self.bot.ticker_to_name[stock_name][:20]:<20}: {stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
-                if len(stock_list) > 600:
-                    stock_list_list.append(stock_list)
-                    stock_list = ""
-            else: # thanks python
-                stock_list_list.append(stock_list)
-            for stock_list in stock_list_list:
+            lines = [f"`{self.bot.ticker_to_name[stock_name][:20]:<20}: {stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
+                     for stock_name, stock_value, stock_avail in stocks]
+            for stock_list in self.join_in_chunks(lines):
                 embed.add_field(
                     name="Channel name | Ticker name | Price | # Available to buy",
                     value=stock_list,
@@ -468,16 +721,11 @@ class StonkCog(commands.Cog):
             )
         elif option == "e" or option == "emoji":
             embed.title = "Emojis detailed view, top 25"
-            self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE stock_name LIKE 'E%' ORDER BY stock_value DESC LIMIT 25")
+            self.c.execute("SELECT stock_name, stock_value, stock_avail FROM stocks WHERE kind = 'E' ORDER BY stock_value DESC LIMIT 25")
             stocks = self.c.fetchall()
-            for stock_name, stock_value, stock_avail in stocks:
-                stock_list += f"{self.bot.ticker_to_name[stock_name]}`: {stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
-                if len(stock_list) > 600:
-                    stock_list_list.append(stock_list)
-                    stock_list = ""
-            else:
-                stock_list_list.append(stock_list)
-            for stock_list in stock_list_list:
+            lines = [f"{self.bot.ticker_to_name[stock_name]}`: {stock_name:<10} ${stock_value:<8.2f} | {stock_avail}`\n"
+                     for stock_name, stock_value, stock_avail in stocks]
+            for stock_list in self.join_in_chunks(lines):
                 embed.add_field(
                     name="Emoji | Ticker name | Price | # Available to buy",
                     value=stock_list,
@@ -485,11 +733,43 @@ class StonkCog(commands.Cog):
                 )
 
         await ctx.send(embed=embed)
+
+    # Joins lines into embed field values, each one ends with the line that takes it past max_len characters
+    def join_in_chunks(self, lines, max_len=600):
+        chunks = []
+        start = 0
+        length = 0
+        for i, line in enumerate(lines):
+            length += len(line)
+            if length > max_len:
+                chunks.append("".join(lines[start:i+1]))
+                start = i + 1
+                length = 0
+        if start < len(lines):
+            chunks.append("".join(lines[start:]))
+        return chunks
+
+    # discord.py's default handler stays quiet for commands with their own error handler, those pass anything they
+    # don't handle here so it still shows up in the logs
+    def log_command_error(self, ctx, error):
+        print(f"Ignoring exception in command {ctx.command}:", file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+    # Returns the user_id with that gamertag, or None if nobody has it
+    def get_user_id_by_gamertag(self, gamertag):
+        user_id = self._gamertag_to_id.get(gamertag)
+        if user_id is None:
+            self.c.execute(SQL_GET_USER_BY_GAMERTAG, (gamertag,))
+            result = self.c.fetchone()
+            if not result:
+                return None
+            user_id = self._gamertag_to_id[gamertag] = result["user_id"]
+        return user_id
             
     @commands.command(name="register")
     async def register(self, ctx, gamertag: str = None):
         # Check if the user is already registered
-        self.c.execute('SELECT user_id FROM users WHERE user_id = ?', (ctx.author.id,))
+        self.c.execute(SQL_GET_USER, (ctx.author.id,))
         result = self.c.fetchone()
 
         if result:
@@ -500,83 +780,92 @@ class StonkCog(commands.Cog):
             await ctx.send("Invalid gamertag! Max 11 characters, lowercase and numbers only")
         else:
             # Register the user with an initial balance
-            self.c.execute('INSERT INTO users (user_id, gamertag, balance) VALUES (?, ?, ?)', (ctx.author.id, gamertag, 100000.0))
-            self.conn.commit()
-            await ctx.send(f"Welcome! You have been registered with an initial balance of $100000.")
+            try:
+                with self.conn:
+                    self.c.execute('INSERT INTO users (user_id, gamertag, balance_cents) VALUES (?, ?, ?)', (ctx.author.id, gamertag, STARTING_BALANCE_CENTS))
+            except sqlite3.IntegrityError:
+                # Gamertag is already taken (unique index)
+                await ctx.send(f"The gamertag `{gamertag}` is already taken. Please choose a different one.")
+                return
+            await ctx.send(f"Welcome! You have been registered with an initial balance of ${STARTING_BALANCE_CENTS // 100}.")
 
     @commands.command(name="buy")
     async def buy_stock(self, ctx, quantity: int, stock_name: str):
-        async with self.buy_lock:
-            # Check if the user is registered
-            self.c.execute('SELECT user_id FROM users WHERE user_id = ?', (ctx.author.id,))
-            result = self.c.fetchone()
-
-            if not result:
-                await ctx.send("You need to register first! Use the `$register` command to get started.")
-                return
-
-            stock_name = stock_name.upper()
-
-            # Check if the stock exists in the database
-            self.c.execute("SELECT stock_value, stock_avail FROM stocks WHERE stock_name = ?", (stock_name,))
-            result = self.c.fetchone()
+        # Check if the user is registered
+        self.c.execute(SQL_GET_USER, (ctx.author.id,))
+        result = self.c.fetchone()
 
-            if not result:
-                await ctx.send("Invalid stock name.")
-                return
+        if not result:
+            await ctx.send("You need to register first! Use the `$register` command to get started.")
+            return
 
-            stock_price, stock_avail = result
+        stock_name = stock_name.upper()
 
-            # Check quantity validity
-            if quantity <= 0:
-                await ctx.send("Positive numbers only")
-                return
-            elif quantity > stock_avail:
-                await ctx.send(f"There are only {stock_avail} available to buy")
-                return
+        # Check if the stock exists in the database
+        self.c.execute("SELECT stock_value, stock_avail FROM stocks WHERE stock_name = ?", (stock_name,))
+        result = self.c.fetchone()
 
-            # Check price validity
-            if stock_price <= 0:
-                await ctx.send("No")
-                return
+        if not result:
+            await ctx.send("Invalid stock name.")
+            return
 
-            total_cost = stock_price * quantity
+        stock_price, stock_avail = result
 
-            # Check user's balance
-            self.c.execute('SELECT balance FROM users WHERE user_id = ?', (ctx.author.id,))
-            balance = self.c.fetchone()[0]
+        # Check quantity validity
+        if quantity <= 0:
+            await ctx.send("Positive numbers only")
+            return
+        elif quantity > stock_avail:
+            await ctx.send(f"There are only {stock_avail} available to buy")
+            return
 
-            if balance < total_cost:
-                await ctx.send(f"You don't have enough money to buy {quantity} shares of {stock_name}. That would cost {total_cost:.2f}, you can buy at most {math.floor(balance/stock_price)}.")
-                return
+        # Check price validity
+        if stock_price <= 0:
+            await ctx.send("No")
+            return
 
-            # Update balance
-            new_balance = balance - total_cost
-            self.c.execute('UPDATE users SET balance = ? WHERE user_id = ?', (new_balance, ctx.author.id))
+        # Costs round up and sale proceeds down, otherwise buying sub-cent stocks one at a time and selling them
+        # together would make money out of rounding
+        total_cost = self.bot.to_cents(stock_price * quantity, ROUND_CEILING)
 
-            # Update the user's stock holdings
-            self.c.execute('SELECT quantity FROM stock_holdings WHERE user_id = ? AND stock_name = ?', (ctx.author.id, stock_name))
-            result = self.c.fetchone()
+        # Check user's balance
+        self.c.execute(SQL_GET_BALANCE, (ctx.author.id,))
+        balance = self.c.fetchone()[0]
 
-            if result:
-                # User already owns this stock, increase the quantity
-                new_quantity = result[0] + quantity
-                self.c.execute('UPDATE stock_holdings SET quantity = ? WHERE user_id = ? AND stock_name = ?', (new_quantity, ctx.author.id, stock_name))
-            else:
-                # User doesn't own this stock, add it
-                self.c.execute('INSERT INTO stock_holdings (user_id, stock_name, quantity) VALUES (?, ?, ?)', (ctx.author.id, stock_name, quantity))
+        if balance < total_cost:
+            await ctx.send(f"You don't have enough money to buy {quantity} shares of {stock_name}. That would cost {total_cost / 100:.2f}, you can buy at most {math.floor(balance / 100 / stock_price)}.")
+            return
 
-            # Update stock availability
-            new_avail = stock_avail - quantity
-            self.c.execute('UPDATE stocks SET stock_avail = ? WHERE stock_name = ?', (new_avail, stock_name))
+        # The checks above are only for the error messages, the updates re-check them in their WHERE clause,
+        # so nothing that changed since (e.g. the hourly update) can make availability or balance go negative.
+        # The with block rolls everything back if anything fails, so no transaction is left open on this connection
+        try:
+            with self.conn:
+                # These return the new availability and balance, the ones read above may be outdated by now
+                self.c.execute(SQL_TAKE_STOCK_AVAIL, (quantity, stock_name, quantity))
+                result = self.c.fetchone()
+                if not result:
+                    raise AbortTransaction(f"Someone else bought {stock_name} first, there are no longer {quantity} available to buy.")
+                new_avail = result["stock_avail"]
+
+                self.c.execute(SQL_DEBIT_BALANCE, (total_cost, ctx.author.id, total_cost))
+                result = self.c.fetchone()
+                if not result:
+                    raise AbortTransaction(f"You don't have enough money to buy {quantity} shares of {stock_name}.")
+                new_balance = result["balance_cents"]
+
+                # Update the user's stock holdings
+                self.c.execute(SQL_UPSERT_HOLDING, (ctx.author.id, stock_name, quantity))
+        except AbortTransaction as e:
+            await ctx.send(str(e))
+            return
 
-            self.conn.commit()
-            await ctx.send(f"You bought {quantity} shares of {stock_name} for ${total_cost:.2f}. Your new balance is ${new_balance:.2f}. There are {new_avail} left for purchase.")
+        await ctx.send(f"You bought {quantity} shares of {stock_name} for ${total_cost / 100:.2f}. Your new balance is ${new_balance / 100:.2f}. There are {new_avail} left for purchase.")
 
     @commands.command(name="sell")
     async def sell_stock(self, ctx, quantity: int, stock_name: str):
         # Check if the user is registered
-        self.c.execute('SELECT user_id FROM users WHERE user_id = ?', (ctx.author.id,))
+        self.c.execute(SQL_GET_USER, (ctx.author.id,))
         result = self.c.fetchone()
 
         if not result:
@@ -586,7 +875,7 @@ class StonkCog(commands.Cog):
         stock_name = stock_name.upper()
 
         # Check if the stock exists in the database
-        self.c.execute("SELECT stock_value FROM stocks WHERE stock_name = ?", (stock_name,))
+        self.c.execute(SQL_GET_STOCK_VALUE, (stock_name,))
         stock = self.c.fetchone()
 
         if not stock:
@@ -594,39 +883,49 @@ class StonkCog(commands.Cog):
             return
 
         stock_price = stock[0]
-        total_sale = stock_price * quantity
 
-        # Get the user's stock holdings
-        self.c.execute('SELECT quantity FROM stock_holdings WHERE user_id = ? AND stock_name = ?', (ctx.author.id, stock_name))
+        if quantity <= 0:
+            await ctx.send("Positive numbers only")
+            return
+
+        # Get the user's stock holdings. Also keeps quantities that don't fit in an SQLite INTEGER away from the updates
+        self.c.execute(SQL_GET_HOLDING, (ctx.author.id, stock_name))
         result = self.c.fetchone()
 
         if not result or result[0] < quantity:
             await ctx.send(f"You don't own enough shares of {stock_name} to sell.")
             return
 
-        # User has enough stock to sell
-        new_quantity = result[0] - quantity
-        if new_quantity == 0:
-            self.c.execute('DELETE FROM stock_holdings WHERE user_id = ? AND stock_name = ?', (ctx.author.id, stock_name))
-        else:
-            self.c.execute('UPDATE stock_holdings SET quantity = ? WHERE user_id = ? AND stock_name = ?', (new_quantity, ctx.author.id, stock_name))
+        total_sale = self.bot.to_cents(stock_price * quantity, ROUND_FLOOR)
 
-        # Update the user's balance
-        self.c.execute('SELECT balance FROM users WHERE user_id = ?', (ctx.author.id,))
-        balance = self.c.fetchone()[0]
-        new_balance = balance + total_sale
-        self.c.execute('UPDATE users SET balance = ? WHERE user_id = ?', (new_balance, ctx.author.id))
+        # Transfers commit from the db thread in between, so only relative updates here, and the holding is re-checked
+        # when taking the stocks. The with block rolls everything back if anything fails
+        try:
+            with self.conn:
+                self.c.execute(SQL_TAKE_HOLDING, (quantity, ctx.author.id, stock_name, quantity))
+                result = self.c.fetchone()
+                if not result:
+                    raise AbortTransaction(f"You don't own enough shares of {stock_name} to sell.")
 
-        # This is atomic, according to chatpit
-        self.c.execute("UPDATE stocks SET stock_avail = stock_avail + ? WHERE stock_name = ?", (quantity, stock_name))
+                if result["quantity"] == 0:
+                    self.c.execute('DELETE FROM stock_holdings WHERE user_id = ? AND stock_name = ? AND quantity = 0', (ctx.author.id, stock_name))
 
-        self.conn.commit()
-        await ctx.send(f"You sold {quantity} shares of {stock_name} for ${total_sale:.2f}. Your new balance is ${new_balance:.2f}.")
+                # Update the user's balance
+                self.c.execute(SQL_CREDIT_BALANCE, (total_sale, ctx.author.id))
+                new_balance = self.c.fetchone()["balance_cents"]
+
+                # This is atomic, according to chatpit
+                self.c.execute("UPDATE stocks SET stock_avail = stock_avail + ? WHERE stock_name = ?", (quantity, stock_name))
+        except AbortTransaction as e:
+            await ctx.send(str(e))
+            return
+
+        await ctx.send(f"You sold {quantity} shares of {stock_name} for ${total_sale / 100:.2f}. Your new balance is ${new_balance / 100:.2f}.")
 
     @commands.command(name="portfolio")
     async def view_portfolio(self, ctx):
         # Retrieve and display the user's portfolio
-        self.c.execute('SELECT balance FROM users WHERE user_id = ?', (ctx.author.id,))
+        self.c.execute(SQL_GET_BALANCE, (ctx.author.id,))
         
         result = self.c.fetchone()
         if not result:
@@ -639,7 +938,7 @@ class StonkCog(commands.Cog):
         self.c.execute('SELECT stock_name, quantity FROM stock_holdings WHERE user_id = ?', (ctx.author.id,))
         holdings = self.c.fetchall()
 
-        portfolio_message = f"**Your Portfolio**\nBalance: ${balance:.2f}\n\nStock Holdings:\n"
+        portfolio_message = f"**Your Portfolio**\nBalance: ${balance / 100:.2f}\n\nStock Holdings:\n"
         if holdings:
             for stock_name, quantity in holdings:
                 portfolio_message += f"{stock_name}: {quantity} shares\n"
@@ -650,16 +949,16 @@ class StonkCog(commands.Cog):
 
     @commands.command(name="leaderboard")
     async def leaderboard(self, ctx):
-        # Fetch all user balances
-        self.c.execute("SELECT user_id, gamertag FROM users")
-        users = self.c.fetchall()
-
-        # Calculate net worth for each user
-        leaderboard_data = [(user_id, gamertag, self.bot.calculate_net_worth(user_id)) for (user_id, gamertag) in users]
-
-        # Sort users by net worth in descending order and get the top 15
-        leaderboard_data.sort(key=lambda x: x[2], reverse=True)
-        top_15 = leaderboard_data[:15]
+        # Calculate net worth for each user and get the top 15
+        self.c.execute('''SELECT u.user_id, u.gamertag,
+                            u.balance_cents + CAST(round(COALESCE(SUM(s.stock_value * h.quantity), 0) * 100) AS INTEGER) AS net_worth
+                        FROM users u
+                        LEFT JOIN stock_holdings h USING (user_id)
+                        LEFT JOIN stocks s USING (stock_name)
+                        GROUP BY u.user_id
+                        ORDER BY net_worth DESC
+                        LIMIT 15''')
+        top_15 = self.c.fetchall()
 
         # Create an embed for the leaderboard
         embed = discord.Embed(title="Net Worth Leaderboard", color=discord.Color.gold())
@@ -669,7 +968,7 @@ class StonkCog(commands.Cog):
         for rank, (user_id, gamertag, net_worth) in enumerate(top_15, start=1):
             user = await self.bot.fetch_user(user_id)
             display_name = user.display_name if user else "Unknown User"
-            leaderboard_message += f"`{rank:>2}. {display_name:<15} ({gamertag}) ${net_worth:.2f}`\n"
+            leaderboard_message += f"`{rank:>2}. {display_name:<15} ({gamertag}) ${net_worth / 100:.2f}`\n"
 
         # Add the leaderboard as a single field
         embed.add_field(name="Top Users", value=leaderboard_message, inline=False)
@@ -678,7 +977,11 @@ class StonkCog(commands.Cog):
 
     @commands.command(name="networth")
     async def networth_command(self, ctx):
-        await ctx.send(f"Your net worth is {self.bot.calculate_net_worth(ctx .author.id):.2f}.")
+        net_worth = self.bot.calculate_net_worth(ctx.author.id)
+        if net_worth is None:
+            await ctx.send("You need to register first! Use the `$register` command to get started.")
+            return
+        await ctx.send(f"Your net worth is {net_worth / 100:.2f}.")
 
     @commands.command(name="rename")
     @commands.cooldown(rate=1, per=86400, type=commands.BucketType.user) # 1 day
@@ -692,118 +995,101 @@ class StonkCog(commands.Cog):
             ctx.command.reset_cooldown(ctx)
             return
 
-        # Check if the new gamertag already exists
-        self.c.execute("SELECT user_id FROM users WHERE gamertag = ?", (gamertag,))
-        if self.c.fetchone():
-            await ctx.send(f"The gamertag `{gamertag}` is already taken. Please choose a different one.")
+        try:
+            await self.bot.run_write(self.bot.change_gamertag, ctx.author.id, gamertag)
+        except AbortTransaction as e:
+            await ctx.send(str(e))
             ctx.command.reset_cooldown(ctx)
             return
+        except Exception:
+            # The write failed on the db thread, the gamertag didn't change so don't use up the cooldown.
+            # rename_error logs it
+            ctx.command.reset_cooldown(ctx)
+            raise
 
-        self.c.execute("UPDATE users SET gamertag = ? WHERE user_id = ?", (gamertag, ctx.author.id))
-        self.conn.commit()
+        # The rename went through, so the user exists. Forget the old gamertag, the database no longer has it
+        for cached_gamertag, user_id in list(self._gamertag_to_id.items()):
+            if user_id == ctx.author.id:
+                del self._gamertag_to_id[cached_gamertag]
+        self._gamertag_to_id[gamertag] = ctx.author.id
     
         await ctx.send(f"Your gamertag has been successfully changed to `{gamertag}`.")
 
     @rename_gamertag.error
     async def rename_error(self, ctx, error):
         if isinstance(error, commands.CommandOnCooldown):
-            retry_after = int(error.retry_after)
-            hours = retry_after // 3600
-            minutes = (retry_after % 3600) // 60
-            await ctx.send(f"Max once per day, you can change your gamertag again in {hours}:{minutes}")
+            # H:MM:SS
+            retry_after = timedelta(seconds=int(error.retry_after))
+            await ctx.send(f"Max once per day, you can change your gamertag again in {retry_after}")
+        else:
+            self.log_command_error(ctx, error)
     
     @commands.command(name="givemoney")
-    async def givemoney(self, ctx, amount: float=0.0, _to: str=None, to_gamertag: str=None):
-        if not amount or not _to or not to_gamertag or not isinstance(amount, float):
+    async def givemoney(self, ctx, amount: commands.Range[float, 0.01, MAX_GIVE_AMOUNT], _to: Literal["to"], to_gamertag: str):
+        # nan passes the range check, every comparison with it is False
+        if not math.isfinite(amount):
             await ctx.send("Usage: `give 420.69 to [gamertag]`, use $leaderboard to find gamertag")
             return
-        elif amount <= 0:
-            await ctx.send("You must specify a positive amount of money.")
-            return
-
-        self.c.execute("SELECT user_id FROM users WHERE gamertag = ?", (to_gamertag,))
-        target = self.c.fetchone()
 
-        if not target:
+        target_id = self.get_user_id_by_gamertag(to_gamertag)
+        if target_id is None:
             await ctx.send(f"User with gamertag '{to_gamertag}' not found, use $leaderboard to find gamertag")
             return
 
         giver_id = ctx.author.id
-        target_id = target[0]
-        self.c.execute("SELECT balance FROM users WHERE user_id = ?", (giver_id,))
-        giver_balance = self.c.fetchone()
-
-        if not giver_balance or giver_balance[0] < amount:
-            await ctx.send(f"You only have ${giver_balance[0]:.2f}.")
+        if target_id == giver_id:
+            await ctx.send("You can't give money to yourself.")
             return
 
-        new_giver_balance = giver_balance[0] - amount
-        self.c.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_giver_balance, giver_id))
-
-        self.c.execute("SELECT balance FROM users WHERE user_id = ?", (target_id,))
-        target_balance = self.c.fetchone()
-
-        if not target_balance:
-            await ctx.send(f"??? somehow the target has no balance, this should never happen")
+        amount_cents = self.bot.to_cents(amount)
+        try:
+            new_giver_balance = await self.bot.run_write(self.bot.transfer_money, giver_id, target_id, amount_cents)
+        except AbortTransaction as e:
+            await ctx.send(str(e))
             return
 
-        new_target_balance = target_balance[0] + amount
-        self.c.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_target_balance, target_id))
-
-        # Commit the changes
-        self.conn.commit()
-
         # Send confirmation message
-        await ctx.send(f"Successfully gave ${amount:.2f} to {to_gamertag}. Your new balance: ${new_giver_balance:.2f}")
+        await ctx.send(f"Successfully gave ${amount_cents / 100:.2f} to {to_gamertag}. Your new balance: ${new_giver_balance / 100:.2f}")
+
+    # Missing or malformed arguments are rejected by the converters before givemoney runs
+    @givemoney.error
+    async def givemoney_error(self, ctx, error):
+        if isinstance(error, commands.RangeError):
+            await ctx.send(f"You must specify an amount between $0.01 and ${MAX_GIVE_AMOUNT:,.0f}.")
+        elif isinstance(error, commands.UserInputError):
+            await ctx.send("Usage: `give 420.69 to [gamertag]`, use $leaderboard to find gamertag")
+        else:
+            self.log_command_error(ctx, error)
 
     @commands.command(name="givestocks")
-    async def givestocks(self, ctx, amount: int=0, stock_name: str=None, _to: str=None, to_gamertag: str=None):
-        # Check for invalid or missing inputs
-        if not amount or not isinstance(amount, int) or not _to or not to_gamertag or not stock_name:
-            await ctx.send("Usage: `givestocks 69 [stock_name] to [gamertag]`, use $leaderboard to find gamertag")
-            return
-        elif amount <= 0:
-            await ctx.send("You must specify a positive amount of stocks.")
-            return
-
-        self.c.execute("SELECT user_id FROM users WHERE gamertag = ?", (to_gamertag,))
-        target = self.c.fetchone()
-
-        if not target:
+    async def givestocks(self, ctx, amount: commands.Range[int, 1, None], stock_name: str, _to: Literal["to"], to_gamertag: str):
+        target_id = self.get_user_id_by_gamertag(to_gamertag)
+        if target_id is None:
             await ctx.send(f"User with gamertag '{to_gamertag}' not found, use $leaderboard to find gamertag")
             return
 
         giver_id = ctx.author.id
-        target_id = target[0]
-
-        self.c.execute("SELECT quantity FROM stock_holdings WHERE user_id = ? AND stock_name = ?", (giver_id, stock_name))
-        giver_stock = self.c.fetchone()
-
-        if not giver_stock:
-            await ctx.send(f"You don't own {stock_name}.")
-            return
-        elif giver_stock[0] < amount:
-            await ctx.send(f"You only have {giver_stock[0]} {stock_name}.")
+        if target_id == giver_id:
+            await ctx.send("You can't give stocks to yourself.")
             return
 
-        new_giver_stock_balance = giver_stock[0] - amount
-        self.c.execute("UPDATE stock_holdings SET quantity = ? WHERE user_id = ? AND stock_name = ?", 
-                    (new_giver_stock_balance, giver_id, stock_name))
+        try:
+            new_giver_stock_balance, new_target_stock_balance = await self.bot.run_write(self.bot.transfer_stocks, giver_id, target_id, stock_name, amount)
+        except AbortTransaction as e:
+            await ctx.send(str(e))
+            return
 
-        self.c.execute("SELECT quantity FROM stock_holdings WHERE user_id = ? AND stock_name = ?", (target_id, stock_name))
-        target_stock = self.c.fetchone()
+        await ctx.send(f"Successfully gave {amount} {stock_name} stocks to {to_gamertag}, they now have {new_target_stock_balance}. "
+                       f"Your new stock balance: {new_giver_stock_balance}.")
 
-        if not target_stock:
-            # If the target has no stocks of this type, insert the new stock record
-            self.c.execute("INSERT INTO stock_holdings (user_id, stock_name, quantity) VALUES (?, ?, ?)", 
-                        (target_id, stock_name, amount))
+    @givestocks.error
+    async def givestocks_error(self, ctx, error):
+        if isinstance(error, commands.RangeError):
+            await ctx.send("You must specify a positive amount of stocks.")
+        elif isinstance(error, commands.UserInputError):
+            await ctx.send("Usage: `givestocks 69 [stock_name] to [gamertag]`, use $leaderboard to find gamertag")
         else:
-            new_target_stock_balance = target_stock[0] + amount
-            self.c.execute("UPDATE stock_holdings SET quantity = ? WHERE user_id = ? AND stock_name = ?", 
-                        (new_target_stock_balance, target_id, stock_name))
-
-        self.conn.commit()
-        await ctx.send(f"Successfully gave {amount} {stock_name} stocks to {to_gamertag}. Your new stock balance: {new_giver_stock_balance}.")
+            self.log_command_error(ctx, error)
 
     # # Debug command to manually advance one hour
     # @commands.command(name="debug_advance")